@@ -1,26 +1,128 @@
 from __future__ import annotations
 
 import os
+import queue
+import threading
+import functools
 import itertools
-from collections import defaultdict
-from dataclasses import dataclass, field
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from dataclasses import dataclass, field, MISSING
 from datetime import datetime
 from enum import Enum
-from typing import Type, Generator, get_args, Dict, ClassVar, Any, Tuple, get_type_hints, Union, Callable, List
+from typing import (
+    Type,
+    Generator,
+    get_args,
+    Dict,
+    ClassVar,
+    Any,
+    Tuple,
+    get_type_hints,
+    Union,
+    Callable,
+    List,
+    Iterable,
+    Optional,
+    Literal,
+)
 
 from google.cloud import datastore
 
+try:
+    from google.cloud.datastore.query import PropertyFilter
+except ImportError:  # older clients have no native IN support
+    PropertyFilter = None
+
 from gcp_pilot import exceptions
 
 DEFAULT_NAMESPACE = os.environ.get("GCP_DATASTORE_NAMESPACE", default=None)
 DEFAULT_PK_FIELD = "id"
+KEY_FIELD = "__key__"
 MAX_ITEMS_PER_OPERATIONS = 500  # Datastore cannot write more than 500 items per call
+MAX_ITEMS_PER_LOOKUP = 1000  # Datastore cannot read more than 1000 keys per call
+MAX_VALUES_PER_IN_FILTER = 30  # Datastore cannot compare against more than 30 values in a single IN filter
+DEFAULT_MAX_WORKERS = 10
+DEDUPE_STRATEGIES = ("set", "bloom", "none")
+MAX_CACHED_PROJECTIONS = 32
+_STARTSWITH_SENTINEL = "\ufffd"  # high code point, so every string with a given prefix sorts before prefix + sentinel
+
+# Clients are shared among all managers of the same namespace, so they reuse the same channel
+_CLIENTS: Dict[Optional[str], datastore.Client] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _ibatch(iterable, n):
+    """Yield successive n-sized chunks from iterable, consuming it lazily."""
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, n)):
+        yield chunk
+
+
+def _stream_pages(jobs: Iterable[Callable[[], Iterable[list]]], workers: int) -> Generator[list, None, None]:
+    """Run page producers in background threads, yielding their pages as soon as they arrive."""
+    jobs = iter(jobs)
+    jobs_lock = threading.Lock()
+    # each worker is at most one page ahead of the consumer
+    results = queue.Queue(maxsize=workers)
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        # after stop is set, a worker puts at most one more item, which fits since the consumer drains the queue
+        if stop.is_set():
+            return False
+        results.put(item)
+        return True
+
+    def _work():
+        try:
+            while True:
+                with jobs_lock:
+                    job = next(jobs, None)
+                if job is None:
+                    break
+                for page in job():
+                    if not _put((page, None)):
+                        return
+        except Exception as exc:  # pylint: disable=broad-except
+            _put((None, exc))
+            return
+        _put((None, None))
+
+    threads = [threading.Thread(target=_work, name="datastore-pages", daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    running = len(threads)
+    try:
+        while running:
+            page, error = results.get()
+            if error is not None:
+                raise error
+            if page is None:
+                running -= 1
+                continue
+            yield page
+    finally:
+        stop.set()
+        while True:
+            try:
+                results.get_nowait()
+            except queue.Empty:
+                break
+
+
+def _build_dedupe(strategy: str) -> Optional[Any]:
+    if strategy == "set":
+        return set()
+
+    if strategy == "bloom":
+        # trades a tiny chance of dropping a result for a fraction of the memory, useful for huge exports
+        from pybloom_live import ScalableBloomFilter  # pylint: disable=import-outside-toplevel
 
+        return ScalableBloomFilter(mode=ScalableBloomFilter.LARGE_SET_GROWTH, error_rate=1e-6)
 
-def _chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
+    return None
 
 
 @dataclass
@@ -39,7 +141,7 @@ def _starts_with_operator(lookup_fields, value) -> List[Tuple[str, str, Any]]:
     field_name = ".".join(lookup_fields)
     return [
         (field_name, ">=", value),
-        (field_name, "<=", f"{value}\ufffd"),
+        (field_name, "<=", value + _STARTSWITH_SENTINEL),
     ]
 
 
@@ -55,90 +157,205 @@ class Manager:
         "startswith": _starts_with_operator,
     }
 
-    _client: ClassVar[datastore.Client] = None
     fields: Dict[str, type]
     pk_field: str
     doc_klass: Type[Document]
     kind: str
+    _field_names: Tuple[str, ...] = field(init=False, repr=False)
+    _pk_type: type = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._field_names = tuple(self.fields)
+        self._pk_type = self.fields[self.pk_field]
 
     def get_client(self) -> datastore.Client:
-        if not self._client:
-            self._client = datastore.Client(namespace=self.get_namespace())
-        return self._client
+        namespace = self.get_namespace()
+        try:
+            return _CLIENTS[namespace]
+        except KeyError:
+            pass
+
+        with _CLIENTS_LOCK:
+            if namespace not in _CLIENTS:
+                _CLIENTS[namespace] = datastore.Client(namespace=namespace)
+        return _CLIENTS[namespace]
 
     def get_namespace(self):
         return self.doc_klass.Meta.namespace
 
     def build_key(self, pk: Any = None) -> datastore.Key:
         if pk:
-            typed_pk = self.doc_klass.Meta.fields[self.pk_field](pk)
-            return self.get_client().key(self.kind, typed_pk)
-        # If no primary key is provided, we let the server create a new ID
-        return self.get_client().allocate_ids(self.get_client().key(self.kind), 1)[0]
-
-    def _iterate(self, query, page_size):
-        cursor = None
-        empty = False
-
-        while not empty:
-            query_iter = query.fetch(start_cursor=cursor, limit=page_size)
-
-            page = next(query_iter.pages, [])
-            for item in page:
-                yield item
-            cursor = query_iter.next_page_token
-            empty = not bool(cursor)
+            return self.get_client().key(self.kind, self._pk_type(pk))
+        # If no primary key is provided, the partial key gets its ID assigned by the server when saved
+        return self.get_client().key(self.kind)
+
+    def _fetch_page(self, query, cursor: bytes, page_size: int, remaining: int = None) -> Tuple[list, bytes]:
+        fetch_limit = page_size if remaining is None else min(page_size or remaining, remaining)
+        query_iter = query.fetch(start_cursor=cursor, limit=fetch_limit)
+        page = list(next(query_iter.pages, []))
+        return page, query_iter.next_page_token
+
+    def _iter_pages(
+        self, query, page_size: int, limit: int = None, cursor: bytes = None
+    ) -> Generator[list, None, None]:
+        remaining = limit
+        while True:
+            page, cursor = self._fetch_page(query=query, cursor=cursor, page_size=page_size, remaining=remaining)
+            if remaining is not None:
+                remaining -= len(page)
+            yield page
+            if not cursor or remaining == 0:
+                return
+
+    def _iterate(self, query, page_size, limit: int = None):
+        page, cursor = self._fetch_page(query=query, cursor=None, page_size=page_size, remaining=limit)
+        remaining = None if limit is None else limit - len(page)
+        if not cursor or remaining == 0:
+            # everything fits in a single page, so there's nothing to prefetch
+            yield from page
+            return
+
+        # the next page is fetched in background while the current one is being consumed
+        pages = _stream_pages(
+            jobs=[
+                lambda: itertools.chain(
+                    [page],
+                    self._iter_pages(query=query, page_size=page_size, limit=remaining, cursor=cursor),
+                )
+            ],
+            workers=1,
+        )
+        for items in pages:
+            yield from items
 
-    def query(
+    def _build_query(
         self,
+        filters: List[Tuple[str, str, Any]],
         distinct_on: str = None,
         order_by: Union[str, List[str]] = None,
-        page_size: int = None,
-        **kwargs,
-    ) -> datastore.query.Iterator:
-        # base query
+    ) -> datastore.query.Query:
         query = self.get_client().query(kind=self.kind)
         if order_by:
-            query.order = order_by
+            query.order = self._build_order(order_by=order_by)
         if distinct_on:
             query.distinct_on = distinct_on
 
-        # parse lookup args
-        cross_filters = []
+        for field_name, operator, field_value in filters:
+            if operator == "in":
+                query.add_filter(filter=PropertyFilter(field_name, "IN", list(field_value)))
+            else:
+                query.add_filter(field_name, operator, field_value)
+        return query
+
+    def _parse_filters(self, **kwargs) -> Tuple[List[Tuple[str, str, Any]], List[List[Tuple[str, str, Any]]]]:
+        filters = []
+        in_filters = []
         for key, value in kwargs.items():
-            all_filters = self._build_filter(key=key, value=value)
-            for field_name, operator, field_value in all_filters:
+            for field_name, operator, field_value in self._build_filter(key=key, value=value):
                 if operator == "in":
-                    cross_filters.append((field_name, operator, field_value))
+                    in_filters.append((field_name, list(field_value)))
                 else:
-                    query.add_filter(field_name, operator, field_value)
+                    filters.append((field_name, operator, field_value))
 
-        if not cross_filters:
-            yield from self._iterate(query=query, page_size=page_size)
-        else:
-            # prepare combinations
-            options = defaultdict(list)
-            for name, operator, values in cross_filters:
-                for value in values:
-                    options[name].append((name, "=", value))
+        # Datastore solves a single IN filter by itself, up to MAX_VALUES_PER_IN_FILTER values per query
+        # (except on keys, which the client only compares one at a time)
+        native = PropertyFilter is not None and len(in_filters) == 1 and in_filters[0][0] != KEY_FIELD
+
+        # each IN lookup becomes the list of alternative filters a combined query picks one from
+        cross_filters = []
+        for field_name, values in in_filters:
+            if native:
+                options = [(field_name, "in", chunk) for chunk in _ibatch(values, MAX_VALUES_PER_IN_FILTER)]
+            else:
+                options = [(field_name, "=", value) for value in values]
+            cross_filters.append(options)
 
-            combinations = itertools.product(*list(options.values()))
+        # with a single combination, there's no need to combine queries
+        if all(len(options) == 1 for options in cross_filters):
+            filters.extend(options[0] for options in cross_filters)
+            cross_filters = []
 
-            found = set()
-            for combination in combinations:
-                current_query = query
-                for field_name, operator, value in combination:
-                    current_query = current_query.add_filter(field_name, operator, value)
+        return filters, cross_filters
 
-                for item in self._iterate(query=current_query, page_size=page_size):
-                    if item.id not in found:
-                        yield item
-                        found.add(item.id)
+    def query(
+        self,
+        distinct_on: str = None,
+        order_by: Union[str, List[str]] = None,
+        page_size: int = None,
+        dedupe: Literal["set", "bloom", "none"] = "set",
+        _limit: int = None,
+        **kwargs,
+    ) -> datastore.query.Iterator:
+        if dedupe not in DEDUPE_STRATEGIES:
+            raise exceptions.UnsupportedFormatException(f"Unsupported dedupe strategy {dedupe}")
+        filters, cross_filters = self._parse_filters(**kwargs)
+
+        if not cross_filters:
+            query = self._build_query(filters=filters, distinct_on=distinct_on, order_by=order_by)
+            yield from self._iterate(query=query, page_size=page_size, limit=_limit)
+            return
+
+        def _job(combination):
+            query = self._build_query(filters=filters + list(combination), distinct_on=distinct_on, order_by=order_by)
+            return lambda: self._iter_pages(query=query, page_size=page_size, limit=_limit)
+
+        jobs = [_job(combination) for combination in itertools.product(*cross_filters)]
+        if not jobs:
+            # an empty IN lookup matches nothing
+            return
+
+        # combinations can match the same entity, unless the caller states they don't
+        found = _build_dedupe(strategy=dedupe)
+        yielded = 0
+        for page in _stream_pages(jobs=jobs, workers=min(DEFAULT_MAX_WORKERS, len(jobs))):
+            for item in page:
+                if found is not None:
+                    # the key path tells entities apart even when they're named, and so have no id
+                    identity = item.key.flat_path
+                    if identity in found:
+                        continue
+                    found.add(identity)
+
+                yield item
+                yielded += 1
+                if yielded == _limit:
+                    return
+
+    def page(
+        self,
+        cursor: bytes = None,
+        page_size: int = None,
+        distinct_on: str = None,
+        order_by: Union[str, List[str]] = None,
+        **kwargs,
+    ) -> Tuple[List[Document], Optional[bytes]]:
+        filters, cross_filters = self._parse_filters(**kwargs)
+        if not all(cross_filters):
+            # an empty IN lookup matches nothing
+            return [], None
+        if cross_filters:
+            raise exceptions.UnsupportedFormatException("Pagination does not support combining multiple IN lookups")
+
+        query = self._build_query(filters=filters, distinct_on=distinct_on, order_by=order_by)
+        query_iter = query.fetch(start_cursor=cursor, limit=page_size)
+        page = next(query_iter.pages, [])
+        # the token is already urlsafe-base64 encoded, so it can be handed to clients as is
+        return [self.from_entity(entity=entity) for entity in page], query_iter.next_page_token
+
+    def _iter_keys(self, page_size: int = None) -> Generator[datastore.Key, None, None]:
+        query = self.get_client().query(kind=self.kind)
+        query.keys_only()
+        for entity in self._iterate(query=query, page_size=page_size):
+            yield entity.key
 
     def filter(self, **kwargs) -> Generator[Document, None, None]:
         for entity in self.query(**kwargs):
             yield self.from_entity(entity=entity)
 
+    def filter_lazy(self, **kwargs) -> Generator[LazyDocument, None, None]:
+        for entity in self.query(**kwargs):
+            yield LazyDocument(entity=entity, meta=self.doc_klass.Meta)
+
     def get(self, **kwargs) -> Document:
         if self.pk_field in kwargs:
             pk = kwargs[self.pk_field]
@@ -148,15 +365,23 @@ class Manager:
             raise DoesNotExist(self.doc_klass, pk)
 
         # Since we can't fetch directly from the key,
-        # we filter and hope for just one object
+        # we filter and hope for just one object (fetching a second one is enough to detect duplicates)
         one_obj = None
-        for obj in self.filter(**kwargs):
+        for obj in self.filter_lazy(_limit=2, **kwargs):
             if one_obj is not None:
                 raise MultipleObjectsFound(self.doc_klass, filters=kwargs)
             one_obj = obj
-        if not one_obj:
+        if one_obj is None:
             raise DoesNotExist(self.doc_klass, filters=kwargs)
-        return one_obj
+        return one_obj.load()
+
+    def get_many(self, pks: Iterable[Any]) -> Dict[Any, Document]:
+        keys = [self.build_key(pk=pk) for pk in pks]
+        found = {}
+        for chunk in _ibatch(keys, MAX_ITEMS_PER_LOOKUP):
+            for entity in self.get_client().get_multi(keys=chunk):
+                found[entity.key.id_or_name] = self.from_entity(entity=entity)
+        return found
 
     def create(self, obj: Document) -> Document:
         entity = self.to_entity(obj=obj)
@@ -167,133 +392,301 @@ class Manager:
             setattr(obj, obj.Meta.pk_field, entity.id)
         return obj
 
-    def update(self, pk: str, **kwargs) -> Document:
-        if kwargs:
-            entity = self.get_client().get(key=self.build_key(pk=pk))
-            # TODO: enable partial nested updates
-            as_data = {
-                key: value.Meta.to_dict(obj=value) if isinstance(value, EmbeddedDocument) else value
-                for key, value in kwargs.items()
-            }
-            entity.update(as_data)
-            self.get_client().put(entity=entity)
-        return self.get(id=pk)
-
-    def delete(self, pk: str = None):
+    def create_many(self, objs: List[Document], max_workers: int = DEFAULT_MAX_WORKERS) -> List[Document]:
+        entities = [self.to_entity(obj=obj) for obj in objs]
+        self._dispatch(
+            func=lambda chunk: self.get_client().put_multi(entities=chunk),
+            chunks=_ibatch(entities, MAX_ITEMS_PER_OPERATIONS),
+            max_workers=max_workers,
+        )
+
+        for obj, entity in zip(objs, entities):
+            if not obj.pk:
+                setattr(obj, obj.Meta.pk_field, entity.id)
+        return objs
+
+    def update_many(self, objs: List[Document], max_workers: int = DEFAULT_MAX_WORKERS) -> List[Document]:
+        if any(not obj.pk for obj in objs):
+            raise exceptions.ValidationError("Cannot update documents without primary key")
+        return self.create_many(objs=objs, max_workers=max_workers)
+
+    def update(self, pk: str = None, obj: Document = None, **kwargs) -> Document:
+        if obj is not None and not isinstance(obj, self.doc_klass):
+            # not a replacement, but a document field that happens to be named obj
+            kwargs["obj"] = obj
+            obj = None
+
+        if obj is not None:
+            # full replacement, so there's no need to read the stored entity first
+            if not obj.pk:
+                raise exceptions.ValidationError("Cannot update a document without primary key")
+            if pk is not None and self._pk_type(pk) != obj.pk:
+                raise exceptions.ValidationError(f"Cannot update {pk} with a document of primary key {obj.pk}")
+            if kwargs:
+                raise exceptions.ValidationError("Cannot update fields when replacing the whole document")
+            self.get_client().put(entity=self.to_entity(obj=obj))
+            return obj
+
+        if not kwargs:
+            return self.get(**{self.pk_field: pk})
+
+        entity = self.get_client().get(key=self.build_key(pk=pk))
+        if not entity:
+            raise DoesNotExist(self.doc_klass, pk)
+
+        # TODO: enable partial nested updates
+        as_data = {
+            key: value.Meta.to_dict(obj=value) if isinstance(value, EmbeddedDocument) else value
+            for key, value in kwargs.items()
+        }
+        entity.update(as_data)
+        self.get_client().put(entity=entity)
+        return self.from_entity(entity=entity)
+
+    def delete(self, pk: str = None, max_workers: int = DEFAULT_MAX_WORKERS):
         if pk:
             self.get_client().delete(key=self.build_key(pk=pk))
         else:
-            keys = [entity.key for entity in self.query()]
-            for chunk in _chunks(keys, MAX_ITEMS_PER_OPERATIONS):
-                self.get_client().delete_multi(keys=chunk)
+            self._dispatch(
+                func=lambda chunk: self.get_client().delete_multi(keys=chunk),
+                chunks=_ibatch(self._iter_keys(), MAX_ITEMS_PER_OPERATIONS),
+                max_workers=max_workers,
+            )
 
-    def _build_filter(self, key: str, value: Any) -> List[Tuple[str, str, Any]]:
-        operator = None
+    def _dispatch(self, func: Callable, chunks: Iterable, max_workers: int) -> None:
+        # the client is shared among the threads, so each chunk is a concurrent RPC over the same channel;
+        # only max_workers chunks are in flight at once, so lazy chunks are not piled up in memory
+        with ThreadPool(processes=max_workers) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(func, (chunk,)))
+                if len(pending) >= max_workers:
+                    pending.popleft().get()
+            for result in pending:
+                result.get()
+
+    @classmethod
+    @functools.lru_cache(maxsize=512)
+    def _parse_lookup(cls, key: str, field_names: Tuple[str, ...]) -> Tuple[str, Tuple[str, ...], Union[str, Callable]]:
+        # parsing does not depend on the value, so it's cached for call sites that repeat the same lookups
+        operator = "="
 
         field_name, *extra = key.split("__")
         if extra:
             if len(extra) > 1:
                 raise exceptions.UnsupportedFormatException(f"Unsupported lookup key format {extra}")
-            operator = extra[0]
-            if operator not in self.lookup_operators:
-                raise exceptions.UnsupportedFormatException(f"Unsupported lookup {operator}")
-            if callable(operator):
-                return operator(field_name, value)
-
-        parts = field_name.split(".")
-        if len(parts) > 1 and parts[0] not in self.fields:
+            lookup = extra[0]
+            if lookup not in cls.lookup_operators:
+                raise exceptions.UnsupportedFormatException(f"Unsupported lookup {lookup}")
+            operator = cls.lookup_operators[lookup]
+
+        parts = tuple(field_name.split("."))
+        if len(parts) > 1 and parts[0] not in field_names:
             raise exceptions.ValidationError(
-                f"{parts[0]} is not a valid field. Excepted one of {' | '.join(self.fields)}"
+                f"{parts[0]} is not a valid field. Excepted one of {' | '.join(field_names)}"
             )
 
-        return [(field_name, (operator or "="), value)]
+        return field_name, parts, operator
+
+    def _build_filter(self, key: str, value: Any) -> List[Tuple[str, str, Any]]:
+        field_name, parts, operator = self._parse_lookup(key, self._field_names)
+        if field_name == self.pk_field:
+            return [self._build_pk_filter(operator=operator, value=value)]
+        if callable(operator):
+            return operator(parts, value)
+        return [(field_name, operator, value)]
+
+    def _build_pk_filter(self, operator: Union[str, Callable], value: Any) -> Tuple[str, str, Any]:
+        # the primary key is always in the entity key, but not always stored as a property
+        if callable(operator):
+            raise exceptions.UnsupportedFormatException(f"Unsupported lookup for primary key {self.pk_field}")
+        if operator == "in":
+            return KEY_FIELD, operator, [self.build_key(pk=pk) for pk in value]
+        return KEY_FIELD, operator, self.build_key(pk=value)
+
+    def _build_order(self, order_by: Union[str, List[str]]) -> Union[str, List[str]]:
+        def _translate(name: str) -> str:
+            if name.lstrip("-") == self.pk_field:
+                return name.replace(self.pk_field, KEY_FIELD)
+            return name
+
+        if isinstance(order_by, str):
+            return _translate(order_by)
+        return [_translate(name) for name in order_by]
 
     def to_entity(self, obj: Document) -> datastore.Entity:
         entity = datastore.Entity(key=self.build_key(pk=obj.pk))
+        data = obj.Meta.to_dict(obj=obj)
         if not obj.pk:
-            setattr(obj, obj.Meta.pk_field, entity.id)
-        entity.update(obj.Meta.to_dict(obj=obj))
+            # the ID is only known after saving, and is kept in the key anyway
+            data.pop(self.pk_field, None)
+        entity.update(data)
         return entity
 
     def from_entity(self, entity: datastore.Entity) -> Document:
         data = dict(entity.items())
-        if self.pk_field not in data:
+        if data.get(self.pk_field) is None:
             data[self.pk_field] = entity.id
         return self.doc_klass.Meta.from_dict(data=data)
 
 
-@dataclass
-class Metadata:
-    fields: Dict[str, type]
-    doc_klass: Type[EmbeddedDocument]
-    pk_field: str = None
-    namespace: str = DEFAULT_NAMESPACE
+class LazyDocument:
+    # Read-only view of an entity that only decodes the fields that are actually accessed
+    __slots__ = ("_entity", "_cache", "_meta")
 
-    def from_dict(self, data: Dict) -> EmbeddedDocument:
-        data = data.copy()
+    def __init__(self, entity: datastore.Entity, meta: Metadata):
+        self._entity = entity
+        self._cache = {}
+        self._meta = meta
 
-        def _build(klass: Union[EmbeddedDocument, Callable], value: Any):
-            if value is None or klass == Any:  # pylint: disable=comparison-with-callable
-                return value
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            # private attributes may not be set yet (eg. copy and pickle create bare instances), so avoid self
+            raise AttributeError(name)
+        if name not in self._meta._field_decoders:
+            raise AttributeError(f"{self._meta.doc_klass.__name__} has no field {name}")
 
-            if issubclass(klass, EmbeddedDocument):
-                return klass.Meta.from_dict(data=value)
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
 
-            if klass == datetime:
-                return klass.fromisoformat(str(value))
+        if name == self._meta.pk_field and self._entity.get(name) is None:
+            value = self._entity.id
+        elif name in self._entity:
+            value = self._meta._field_decoders[name](self._entity[name])
+        else:
+            value = self._get_default(name=name)
 
-            return klass(value)
+        self._cache[name] = value
+        return value
 
-        parsed_data = {}
-        for field_name, field_klass in self.fields.items():
-            try:
-                raw_value = data[field_name]
-            except KeyError:
-                continue
+    def _get_default(self, name: str) -> Any:
+        dataclass_field = self._meta.doc_klass.__dataclass_fields__[name]
+        if dataclass_field.default_factory is not MISSING:
+            return dataclass_field.default_factory()
+        if dataclass_field.default is not MISSING:
+            return dataclass_field.default
+        raise AttributeError(f"{self._meta.doc_klass.__name__} has no value for field {name}")
 
-            if getattr(field_klass, "_name", "") == "List":
-                inner_klass = get_args(field_klass)[0]  # TODO: test composite types
-                item = [_build(klass=inner_klass, value=i) for i in raw_value]
-            elif getattr(field_klass, "_name", "") == "Dict":
-                inner_klass_key, inner_klass_value = get_args(field_klass)
-                item = {
-                    _build(klass=inner_klass_key, value=k): _build(klass=inner_klass_value, value=v)
-                    for k, v in raw_value.items()
-                }
-            else:
-                item = _build(klass=field_klass, value=raw_value)
-            parsed_data[field_name] = item
+    def __repr__(self) -> str:
+        return f"<Lazy{self._meta.doc_klass.__name__} {self._entity.key}>"
 
-        return self.doc_klass(**parsed_data)
+    @property
+    def pk(self):
+        return getattr(self, self._meta.pk_field)
 
-    def to_dict(self, obj: EmbeddedDocument, select_fields: List[str] = None) -> dict:
-        # TODO handle custom dynamic fields
-        def _unbuild(value):
-            if value is None:
-                return value
-            if isinstance(value, EmbeddedDocument):
-                return value.Meta.to_dict(obj=value)
-            if isinstance(value, Enum):
-                return value.value
-            return value
-
-        data = {}
-        for field_name, field_klass in self.fields.items():
-            if select_fields and field not in select_fields:
-                continue
+    def load(self) -> Document:
+        return self._meta.doc_klass.documents.from_entity(entity=self._entity)
 
-            raw_value = getattr(obj, field_name)
 
-            if getattr(field_klass, "_name", "") == "List":
-                item = [_unbuild(value=i) for i in raw_value]
-            elif getattr(field_klass, "_name", "") == "Dict":
-                item = {_unbuild(value=k): _unbuild(value=v) for k, v in raw_value.items()}
-            else:
-                item = _unbuild(value=raw_value)
+def _build_decoder(klass: Union[Type[EmbeddedDocument], Callable]) -> Callable[[Any], Any]:
+    if klass == Any:  # pylint: disable=comparison-with-callable
+        return lambda value: value
 
-            data[field_name] = item
+    if isinstance(klass, type) and issubclass(klass, EmbeddedDocument):
+        return lambda value: value if value is None else klass.Meta.from_dict(data=value)
 
-        return data
+    if klass == datetime:
+        return lambda value: value if value is None else klass.fromisoformat(str(value))
+
+    return lambda value: value if value is None else klass(value)
+
+
+def _build_field_decoder(field_klass: type) -> Callable[[Any], Any]:
+    if getattr(field_klass, "_name", "") == "List":
+        inner_decoder = _build_decoder(klass=get_args(field_klass)[0])  # TODO: test composite types
+        return lambda raw_value: [inner_decoder(i) for i in raw_value]
+
+    if getattr(field_klass, "_name", "") == "Dict":
+        key_decoder, value_decoder = [_build_decoder(klass=klass) for klass in get_args(field_klass)]
+        return lambda raw_value: {key_decoder(k): value_decoder(v) for k, v in raw_value.items()}
+
+    return _build_decoder(klass=field_klass)
+
+
+def _unbuild(value: Any) -> Any:
+    if value is None:
+        return value
+    if isinstance(value, EmbeddedDocument):
+        return value.Meta.to_dict(obj=value)
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+
+def _build_field_encoder(field_klass: type) -> Callable[[Any], Any]:
+    if getattr(field_klass, "_name", "") == "List":
+        return lambda raw_value: [_unbuild(value=i) for i in raw_value]
+
+    if getattr(field_klass, "_name", "") == "Dict":
+        return lambda raw_value: {_unbuild(value=k): _unbuild(value=v) for k, v in raw_value.items()}
+
+    return _unbuild
+
+
+@dataclass
+class Metadata:
+    fields: Dict[str, type]
+    doc_klass: Type[EmbeddedDocument]
+    pk_field: str = None
+    namespace: str = DEFAULT_NAMESPACE
+    _field_decoders: Dict[str, Callable[[Any], Any]] = field(default_factory=dict, init=False, repr=False)
+    _field_encoders: Dict[str, Callable[[Any], Any]] = field(default_factory=dict, init=False, repr=False)
+    _get_projection: Callable[[frozenset], Callable[..., Dict]] = field(default=None, init=False, repr=False)
+    _from_dict: Callable[[Dict], EmbeddedDocument] = field(default=None, init=False, repr=False)
+    _to_dict: Callable[[EmbeddedDocument], Dict] = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        # resolve how each field is (de)serialized just once, instead of inspecting the types for every object
+        self._field_decoders = {name: _build_field_decoder(field_klass=k) for name, k in self.fields.items()}
+        self._field_encoders = {name: _build_field_encoder(field_klass=k) for name, k in self.fields.items()}
+        self._from_dict = self._build_from_dict()
+        self._to_dict = self._build_to_dict()
+        # projections are compiled on demand, and only the most used selections are kept around
+        self._get_projection = functools.lru_cache(maxsize=MAX_CACHED_PROJECTIONS)(self._build_to_dict)
+
+    def from_dict(self, data: Dict) -> EmbeddedDocument:
+        return self._from_dict(data)
+
+    def to_dict(self, obj: EmbeddedDocument, select_fields: List[str] = None) -> dict:
+        # TODO handle custom dynamic fields
+        if select_fields:
+            return self._get_projection(frozenset(select_fields))(obj)
+        return self._to_dict(obj)
+
+    def _compile(self, name: str, lines: List[str], namespace: Dict[str, Any]) -> Callable:
+        source = "\n".join(lines)
+        code = compile(source, f"<datastore {self.doc_klass.__qualname__}.{name}>", "exec")
+        exec(code, namespace)  # pylint: disable=exec-used
+        return namespace[name]
+
+    def _build_from_dict(self) -> Callable[[Dict], EmbeddedDocument]:
+        # straight-line version of from_dict, with the field names and decoders baked in
+        namespace = {"_klass": self.doc_klass}
+        lines = ["def from_dict(data):", "    parsed_data = {}"]
+        for index, (field_name, decoder) in enumerate(self._field_decoders.items()):
+            lines.append(f"    if {field_name!r} in data:")
+            if self.fields[field_name] == Any:
+                lines.append(f"        parsed_data[{field_name!r}] = data[{field_name!r}]")
+            else:
+                namespace[f"_decode_{index}"] = decoder
+                lines.append(f"        parsed_data[{field_name!r}] = _decode_{index}(data[{field_name!r}])")
+        lines.append("    return _klass(**parsed_data)")
+        return self._compile(name="from_dict", lines=lines, namespace=namespace)
+
+    def _build_to_dict(self, select_fields: frozenset = None) -> Callable[[EmbeddedDocument], Dict]:
+        # straight-line version of to_dict, with the field names and encoders baked in;
+        # a projection only handles the selected fields
+        namespace = {}
+        lines = ["def to_dict(obj):", "    return {"]
+        for index, (field_name, encoder) in enumerate(self._field_encoders.items()):
+            if select_fields is not None and field_name not in select_fields:
+                continue
+            namespace[f"_encode_{index}"] = encoder
+            lines.append(f"        {field_name!r}: _encode_{index}(obj.{field_name}),")
+        lines.append("    }")
+        return self._compile(name="to_dict", lines=lines, namespace=namespace)
 
 
 class ORM(type):
@@ -366,6 +759,8 @@ class ORM(type):
 
 @dataclass
 class EmbeddedDocument(metaclass=ORM):
+    # no instance dict here, so subclasses declared with @dataclass(slots=True) are fully slotted
+    __slots__ = ()
     Meta: ClassVar[Metadata]
 
     @classmethod
@@ -378,6 +773,7 @@ class EmbeddedDocument(metaclass=ORM):
 
 @dataclass
 class Document(EmbeddedDocument):
+    __slots__ = ()
     documents: ClassVar[Manager]
 
     @property
@@ -396,4 +792,5 @@ __all__ = (
     "MultipleObjectsFound",
     "EmbeddedDocument",
     "Document",
+    "LazyDocument",
 )
@@ -1,7 +1,667 @@
+import base64
+import copy
+import json
+import sys
+import threading
+import time
 import unittest
+from dataclasses import dataclass, field
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, List
+from unittest.mock import patch
 
-from gcp_pilot.datastore import Document  # pylint: disable=unused-import
+from google.cloud import datastore
 
+from gcp_pilot import datastore as gcp_datastore
+from gcp_pilot.datastore import Document, EmbeddedDocument
 
-class TestDatastore(unittest.TestCase):
-    pass
+PROJECT = "potato-dev"
+
+
+@dataclass
+class Item(Document):
+    name: str = None
+    color: str = None
+    size: int = None
+    tags: List[str] = field(default_factory=list)
+
+
+class Shape(Enum):
+    ROUND = "round"
+    SQUARE = "square"
+
+
+@dataclass
+class Address(EmbeddedDocument):
+    street: str = None
+    number: int = None
+
+
+@dataclass
+class Profile(Document):
+    name: str = None
+    shape: Shape = None
+    born_at: datetime = None
+    address: Address = None
+    addresses: List[Address] = field(default_factory=list)
+    scores: Dict[str, int] = field(default_factory=dict)
+    extra: Any = None
+
+
+@dataclass
+class Note(Document):
+    __namespace__ = "notes"
+    text: str = None
+
+
+@dataclass
+class Box(Document):
+    obj: str = None
+
+
+@dataclass
+class Tag(Document):
+    id: str = None
+    name: str = None
+    color: str = None
+
+
+class FakeQuery:
+    def __init__(self, client, kind):
+        self.client = client
+        self.kind = kind
+        self.filters = []
+        self.order = None
+        self.distinct_on = None
+        self.projection = []
+
+    def keys_only(self):
+        self.projection = ["__key__"]
+
+    def add_filter(self, property_name=None, operator=None, value=None, *, filter=None):
+        if filter is not None:
+            property_name, operator, value = filter.property_name, filter.operator, filter.value
+        self.filters.append((property_name, operator, value))
+        return self
+
+    def _matches(self, entity):
+        operations = {
+            "=": lambda a, b: a == b,
+            ">": lambda a, b: a > b,
+            ">=": lambda a, b: a >= b,
+            "<": lambda a, b: a < b,
+            "<=": lambda a, b: a <= b,
+            "IN": lambda a, b: a in b,
+        }
+        for name, operator, value in self.filters:
+            current = entity.key if name == "__key__" else entity.get(name)
+            if current is None or not operations[operator](current, value):
+                return False
+        return True
+
+    def fetch(self, start_cursor=None, limit=None):
+        return self.client.run_query(query=self, start_cursor=start_cursor, limit=limit)
+
+
+class FakeIterator:
+    def __init__(self, page, next_page_token):
+        self.pages = iter([page])
+        self.next_page_token = next_page_token
+
+
+class FakeClient:
+    """In-memory stand-in for datastore.Client, storing real entities and keys."""
+
+    max_page_size = 3
+
+    def __init__(self):
+        self.entities = {}
+        self.calls = []
+        self.last_id = 1000
+
+    def key(self, kind, *path):
+        return datastore.Key(kind, *path, project=PROJECT)
+
+    def query(self, kind):
+        return FakeQuery(client=self, kind=kind)
+
+    @staticmethod
+    def _position(key):
+        # like Datastore, numeric ids come before names
+        return isinstance(key.id_or_name, str), key.id_or_name
+
+    def run_query(self, query, start_cursor, limit):
+        keys_only = query.projection == ["__key__"]
+        self.calls.append(("fetch_keys" if keys_only else "fetch", start_cursor, limit))
+        rows = [
+            entity
+            for key, entity in sorted(self.entities.items(), key=lambda item: self._position(item[0]))
+            if key.kind == query.kind and query._matches(entity)
+        ]
+        # like Datastore, the cursor is a position after the last returned key, not an offset
+        if start_cursor:
+            after = tuple(json.loads(base64.urlsafe_b64decode(start_cursor)))
+            rows = [entity for entity in rows if self._position(entity.key) > after]
+        size = min(limit or self.max_page_size, self.max_page_size)
+        page = [datastore.Entity(key=entity.key) for entity in rows[:size]] if keys_only else rows[:size]
+        token = None
+        if len(rows) > size:
+            token = base64.urlsafe_b64encode(json.dumps(self._position(page[-1].key)).encode())
+        return FakeIterator(page=page, next_page_token=token)
+
+    def _store(self, entity):
+        if entity.key.is_partial:
+            self.last_id += 1
+            entity.key = entity.key.completed_key(self.last_id)
+        stored = datastore.Entity(key=entity.key)
+        stored.update(entity)
+        self.entities[entity.key] = stored
+
+    def put(self, entity):
+        self.calls.append(("put", 1))
+        self._store(entity)
+
+    def put_multi(self, entities):
+        self.calls.append(("put_multi", len(entities)))
+        for entity in entities:
+            self._store(entity)
+
+    def get(self, key):
+        self.calls.append(("get", 1))
+        return self.entities.get(key)
+
+    def get_multi(self, keys):
+        self.calls.append(("get_multi", len(keys)))
+        return [self.entities[key] for key in keys if key in self.entities]
+
+    def delete(self, key):
+        self.calls.append(("delete", 1))
+        self.entities.pop(key, None)
+
+    def delete_multi(self, keys):
+        self.calls.append(("delete_multi", len(keys)))
+        for key in keys:
+            self.entities.pop(key, None)
+
+
+class DatastoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient()
+        patcher = patch.dict(gcp_datastore._CLIENTS, {None: self.client})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def calls_to(self, method):
+        return [call[1] for call in self.client.calls if call[0] == method]
+
+
+class TestClientRegistry(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.dict(gcp_datastore._CLIENTS, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch("gcp_pilot.datastore.datastore.Client")
+    def test_clients_are_shared_per_namespace(self, client_klass):
+        client_klass.side_effect = lambda namespace: object()
+
+        self.assertIs(Item.documents.get_client(), Profile.documents.get_client())
+        self.assertIsNot(Item.documents.get_client(), Note.documents.get_client())
+        self.assertIs(Note.documents.get_client(), Note.documents.get_client())
+        self.assertEqual([None, "notes"], [call.kwargs["namespace"] for call in client_klass.call_args_list])
+
+    @patch("gcp_pilot.datastore.datastore.Client")
+    def test_concurrent_clients(self, client_klass):
+        def _slow_client(namespace):
+            time.sleep(0.05)  # gives the other threads time to race for the same namespace
+            return object()
+
+        client_klass.side_effect = _slow_client
+        barrier = threading.Barrier(8)
+        clients = []
+
+        def _get_client():
+            barrier.wait()
+            clients.append(Item.documents.get_client())
+
+        threads = [threading.Thread(target=_get_client) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, client_klass.call_count)
+        self.assertEqual(1, len({id(client) for client in clients}))
+
+
+class TestManagerBatches(DatastoreTestCase):
+    def test_create_many(self):
+        items = [Item(name=f"item-{i}") for i in range(1200)]
+        Item.documents.create_many(objs=items)
+
+        self.assertEqual([500, 500, 200], sorted(self.calls_to("put_multi"), reverse=True))
+        self.assertEqual(1200, len({item.id for item in items}))
+        self.assertTrue(all(item.id for item in items))
+        self.assertEqual("item-0", self.client.entities[Item.documents.build_key(pk=items[0].id)]["name"])
+
+    def test_get_many(self):
+        items = Item.documents.create_many(objs=[Item(name=f"item-{i}") for i in range(3)])
+        missing_pk = 999_999
+
+        found = Item.documents.get_many(pks=[item.id for item in items] + [missing_pk])
+
+        self.assertEqual({item.id: item for item in items}, found)
+        self.assertEqual([4], self.calls_to("get_multi"))
+
+    def test_get_many_batches(self):
+        Item.documents.get_many(pks=range(1, 2501))
+        self.assertEqual([1000, 1000, 500], self.calls_to("get_multi"))
+
+    def test_update_many_requires_pk(self):
+        with self.assertRaises(gcp_datastore.exceptions.ValidationError):
+            Item.documents.update_many(objs=[Item(name="new")])
+
+    def test_delete_all(self):
+        Item.documents.create_many(objs=[Item(name=f"item-{i}") for i in range(1200)])
+        Item.documents.delete(max_workers=2)
+
+        self.assertEqual({}, self.client.entities)
+        self.assertEqual([500, 500, 200], sorted(self.calls_to("delete_multi"), reverse=True))
+        self.assertEqual([], self.calls_to("fetch"))  # only keys are read
+        self.assertTrue(self.calls_to("fetch_keys"))
+
+
+class TestManagerUpdate(DatastoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.item = Item.documents.create(obj=Item(name="old", color="red"))
+        self.client.calls.clear()
+
+    def test_partial_update(self):
+        updated = Item.documents.update(pk=self.item.id, name="new")
+
+        self.assertEqual(Item(id=self.item.id, name="new", color="red"), updated)
+        self.assertEqual("new", self.client.entities[Item.documents.build_key(pk=self.item.id)]["name"])
+        self.assertEqual([1], self.calls_to("get"))  # no second read to return the result
+        self.assertEqual([1], self.calls_to("put"))
+
+    def test_partial_update_missing(self):
+        with self.assertRaises(gcp_datastore.DoesNotExist):
+            Item.documents.update(pk=999_999, name="new")
+        self.assertEqual([], self.calls_to("put"))
+
+    def test_replace(self):
+        replacement = Item(id=self.item.id, name="new")
+        self.assertIs(replacement, Item.documents.update(obj=replacement))
+        self.assertIs(replacement, Item.documents.update(pk=self.item.id, obj=replacement))
+
+        stored = self.client.entities[Item.documents.build_key(pk=self.item.id)]
+        self.assertEqual("new", stored["name"])
+        self.assertIsNone(stored["color"])
+        self.assertEqual([], self.calls_to("get"))  # no read before replacing
+        self.assertEqual([1, 1], self.calls_to("put"))
+
+    def test_replace_rejects_invalid_calls(self):
+        invalid_calls = {
+            "no pk": dict(obj=Item(name="new")),
+            "other pk": dict(pk=self.item.id + 1, obj=Item(id=self.item.id, name="new")),
+            "with fields": dict(obj=Item(id=self.item.id), name="new"),
+        }
+        for case, kwargs in invalid_calls.items():
+            with self.subTest(case=case):
+                with self.assertRaises(gcp_datastore.exceptions.ValidationError):
+                    Item.documents.update(**kwargs)
+        self.assertEqual([], self.calls_to("put"))
+
+    def test_update_field_named_obj(self):
+        box = Box.documents.create(obj=Box(obj="old"))
+
+        self.assertEqual(Box(id=box.id, obj="new"), Box.documents.update(pk=box.id, obj="new"))
+
+
+class TestManagerQuery(DatastoreTestCase):
+    def setUp(self):
+        super().setUp()
+        Item.documents.create_many(
+            objs=[Item(name=f"item-{i}", color=["red", "blue"][i % 2], size=i % 3) for i in range(12)]
+        )
+
+    def assertNoPageThreads(self):
+        for thread in threading.enumerate():
+            if thread.name == "datastore-pages":
+                thread.join(timeout=1)
+                self.assertFalse(thread.is_alive())
+
+    def test_combined_in_lookups(self):
+        items = list(Item.documents.filter(color__in=["red", "blue"], size__in=[0, 1]))
+
+        expected = {f"item-{i}" for i in range(12) if i % 3 in (0, 1)}
+        self.assertEqual(expected, {item.name for item in items})
+        self.assertEqual(len(expected), len(items))
+
+    def test_combined_in_lookups_stream_results(self):
+        release = threading.Event()
+        run_query = self.client.run_query
+
+        def _blocking_run_query(query, start_cursor, limit):
+            if start_cursor:  # hold every follow-up page
+                release.wait(timeout=5)
+            return run_query(query=query, start_cursor=start_cursor, limit=limit)
+
+        self.client.max_page_size = 1
+        with patch.object(self.client, "run_query", side_effect=_blocking_run_query):
+            results = Item.documents.filter(color__in=["red", "blue"], size__in=[0, 1])
+            start = time.monotonic()
+            next(results)
+            self.assertLess(time.monotonic() - start, 1)  # a page is yielded before any combination is fully read
+            release.set()
+            results.close()
+
+        self.assertNoPageThreads()
+
+    def test_combined_in_lookups_dedupe(self):
+        lookups = dict(name__in=["item-0", "item-1"], size__in=[0, 1, 2])
+        Tag.documents.create_many(objs=[Tag(id=pk, name=f"tag-{pk}", color="red") for pk in "abc"])
+        for dedupe in ["set", "bloom", "none"]:
+            with self.subTest(dedupe=dedupe):
+                items = list(Item.documents.filter(dedupe=dedupe, **lookups))
+                self.assertEqual(["item-0", "item-1"], sorted(item.name for item in items))
+
+                # named keys have no id, so they must be told apart by the whole key
+                tags = list(Tag.documents.filter(dedupe=dedupe, id__in=["a", "b", "c"]))
+                self.assertEqual(["a", "b", "c"], sorted(tag.id for tag in tags))
+                tags = list(Tag.documents.filter(dedupe=dedupe, name__in=["tag-a", "tag-c"], color__in=["red"]))
+                self.assertEqual(["a", "c"], sorted(tag.id for tag in tags))
+
+    def test_invalid_dedupe(self):
+        with self.assertRaises(gcp_datastore.exceptions.UnsupportedFormatException):
+            list(Item.documents.filter(dedupe="bogus", color="red"))
+
+    def test_single_in_lookup(self):
+        items = list(Item.documents.filter(name__in=["item-0", "item-5"]))
+        self.assertEqual(["item-0", "item-5"], sorted(item.name for item in items))
+        self.assertEqual([None], self.calls_to("fetch"))  # a single query, with a native IN filter
+
+    def test_single_in_lookup_over_the_limit(self):
+        names = [f"item-{i}" for i in range(gcp_datastore.MAX_VALUES_PER_IN_FILTER + 1)]
+        items = list(Item.documents.filter(name__in=names))
+        self.assertEqual(12, len(items))
+        self.assertEqual([None, None], [cursor for cursor in self.calls_to("fetch") if cursor is None])
+
+    def test_empty_in_lookup(self):
+        self.assertEqual([], list(Item.documents.filter(name__in=[])))
+        self.assertEqual([], list(Item.documents.filter(id__in=[])))
+        self.assertEqual([], list(Item.documents.filter(name__in=[], size__in=[0, 1])))
+        self.assertEqual(([], None), Item.documents.page(name__in=[]))
+        self.assertEqual([], self.calls_to("fetch"))
+
+    def test_combined_in_lookups_limit(self):
+        items = list(Item.documents.query(color__in=["red", "blue"], size__in=[0, 1, 2], _limit=2))
+        self.assertEqual(2, len(items))
+        self.assertNoPageThreads()
+
+    def test_iterate_prefetches_pages(self):
+        with patch.object(gcp_datastore, "_stream_pages", wraps=gcp_datastore._stream_pages) as stream_pages:
+            items = list(Item.documents.filter())
+        self.assertEqual([f"item-{i}" for i in range(12)], [item.name for item in items])
+        stream_pages.assert_called_once()
+        self.assertNoPageThreads()
+
+    def test_iterate_single_page_starts_no_thread(self):
+        with patch.object(gcp_datastore, "_stream_pages") as stream_pages:
+            self.assertEqual(["item-0"], [item.name for item in Item.documents.filter(name="item-0")])
+            self.assertEqual(3, len(list(Item.documents.query(_limit=3))))
+        stream_pages.assert_not_called()
+
+    def test_iterate_propagates_errors(self):
+        run_query = self.client.run_query
+
+        def _failing_run_query(query, start_cursor, limit):
+            if start_cursor:
+                raise gcp_datastore.exceptions.NotFound("page is gone")
+            return run_query(query=query, start_cursor=start_cursor, limit=limit)
+
+        with patch.object(self.client, "run_query", side_effect=_failing_run_query):
+            with self.assertRaises(gcp_datastore.exceptions.NotFound):
+                list(Item.documents.filter())
+
+        self.assertNoPageThreads()
+
+    def test_iterate_close(self):
+        self.client.max_page_size = 1
+        results = Item.documents.filter()
+        self.assertEqual("item-0", next(results).name)
+        self.assertEqual("item-1", next(results).name)
+        results.close()
+
+        self.assertNoPageThreads()
+
+    def test_page_round_trips_cursor(self):
+        names = []
+        items, cursor = Item.documents.page(page_size=5)
+        self.assertEqual(3, len(items))  # capped by the server page size
+        names += [item.name for item in items]
+
+        while cursor:
+            requested = cursor
+            items, cursor = Item.documents.page(cursor=cursor, page_size=5)
+            self.assertEqual(("fetch", requested, 5), self.client.calls[-1])
+            names += [item.name for item in items]
+
+        self.assertEqual([f"item-{i}" for i in range(12)], names)
+
+    def test_page_with_filters(self):
+        items, cursor = Item.documents.page(page_size=2, color="red")
+        self.assertEqual(["item-0", "item-2"], [item.name for item in items])
+
+        items, cursor = Item.documents.page(cursor=cursor, page_size=10, color="red")
+        self.assertEqual(["item-4", "item-6", "item-8"], [item.name for item in items])
+
+    def test_page_rejects_combined_in_lookups(self):
+        with self.assertRaises(gcp_datastore.exceptions.UnsupportedFormatException):
+            Item.documents.page(color__in=["red", "blue"], size__in=[0, 1])
+
+
+class TestMetadata(unittest.TestCase):
+    def _sample(self):
+        return Profile(
+            id=42,
+            name="Chuck",
+            shape=Shape.ROUND,
+            born_at=datetime(1940, 3, 10, 12, 30),
+            address=Address(street="Main St", number=1),
+            addresses=[Address(street="Side St", number=2), Address(street="Back St")],
+            scores={"kicks": 10},
+            extra={"any": ["thing", 1]},
+        )
+
+    def test_to_dict(self):
+        expected = {
+            "id": 42,
+            "name": "Chuck",
+            "shape": "round",
+            "born_at": datetime(1940, 3, 10, 12, 30),
+            "address": {"street": "Main St", "number": 1},
+            "addresses": [{"street": "Side St", "number": 2}, {"street": "Back St", "number": None}],
+            "scores": {"kicks": 10},
+            "extra": {"any": ["thing", 1]},
+        }
+        self.assertEqual(expected, self._sample().serialize())
+
+    def test_round_trip(self):
+        profile = self._sample()
+        data = Profile.Meta.to_dict(obj=profile)
+        data["born_at"] = data["born_at"].isoformat()  # datetimes are also parsed from strings
+
+        self.assertEqual(profile, Profile.Meta.from_dict(data=data))
+
+    def test_to_dict_projection(self):
+        data = Profile.Meta.to_dict(obj=self._sample(), select_fields=["name", "address"])
+        self.assertEqual({"name": "Chuck", "address": {"street": "Main St", "number": 1}}, data)
+
+    def test_to_dict_projection_cache_is_bounded(self):
+        profile = self._sample()
+        for size in range(gcp_datastore.MAX_CACHED_PROJECTIONS * 2):
+            Profile.Meta.to_dict(obj=profile, select_fields=["name", f"unknown_{size}"])
+
+        cache = Profile.Meta._get_projection.cache_info()  # pylint: disable=protected-access
+        self.assertEqual(gcp_datastore.MAX_CACHED_PROJECTIONS, cache.currsize)
+
+    def test_from_dict_uses_defaults(self):
+        profile = Profile.deserialize(name="Chuck", address=None)
+        self.assertEqual(Profile(name="Chuck"), profile)
+
+
+class TestLazyDocument(DatastoreTestCase):
+    def _store(self, pk, **properties):
+        entity = datastore.Entity(key=Item.documents.build_key(pk=pk))
+        entity.update(properties)
+        self.client.entities[entity.key] = entity
+
+    def test_decodes_stored_fields(self):
+        self._store(pk=7, id=7, name="seven", size=3, tags=["a"])
+
+        [lazy] = list(Item.documents.filter_lazy(name="seven"))
+        self.assertEqual("seven", lazy.name)
+        self.assertEqual(3, lazy.size)
+        self.assertEqual(["a"], lazy.tags)
+        self.assertEqual(7, lazy.pk)
+        self.assertEqual(Item(id=7, name="seven", size=3, tags=["a"]), lazy.load())
+
+    def test_missing_fields_fall_back(self):
+        self._store(pk=8, name="eight")  # no id, color, size or tags properties
+
+        [lazy] = list(Item.documents.filter_lazy(name="eight"))
+        self.assertEqual(8, lazy.id)  # from the key
+        self.assertIsNone(lazy.color)  # from the default
+        self.assertEqual([], lazy.tags)  # from the default factory
+        self.assertEqual(Item(id=8, name="eight"), lazy.load())
+
+    def test_unknown_field(self):
+        self._store(pk=9, name="nine")
+
+        [lazy] = list(Item.documents.filter_lazy())
+        with self.assertRaises(AttributeError):
+            getattr(lazy, "weight")
+
+    def test_private_attributes_of_bare_instance(self):
+        bare = gcp_datastore.LazyDocument.__new__(gcp_datastore.LazyDocument)
+        with self.assertRaises(AttributeError):
+            getattr(bare, "_meta")
+        copy.copy(bare)
+
+    def test_copy(self):
+        self._store(pk=10, name="ten")
+
+        [lazy] = list(Item.documents.filter_lazy())
+        self.assertEqual("ten", copy.copy(lazy).name)
+
+    def test_get_uses_single_match(self):
+        for pk in range(10, 15):
+            self._store(pk=pk, name=f"item-{pk}", color="red")
+
+        self.assertEqual(Item(id=10, name="item-10", color="red"), Item.documents.get(name="item-10"))
+        with self.assertRaises(gcp_datastore.MultipleObjectsFound):
+            Item.documents.get(color="red")
+        # a second match is enough to detect duplicates, so the other matches are never fetched
+        self.assertEqual([2, 2], [call[2] for call in self.client.calls if call[0] == "fetch"])
+        with self.assertRaises(gcp_datastore.DoesNotExist):
+            Item.documents.get(name="twelve")
+
+
+@unittest.skipIf(sys.version_info < (3, 10), "dataclass slots require Python 3.10")
+class TestSlottedDocument(DatastoreTestCase):
+    @classmethod
+    def setUpClass(cls):
+        @dataclass(slots=True)  # pylint: disable=unexpected-keyword-arg
+        class Point(EmbeddedDocument):
+            x: int = 0
+            y: int = 0
+
+        @dataclass(slots=True)  # pylint: disable=unexpected-keyword-arg
+        class Shelf(Document):
+            name: str = None
+            corner: Point = None
+            labels: List[str] = field(default_factory=list)
+
+        cls.point_klass = Point
+        cls.shelf_klass = Shelf
+
+    def test_metadata_points_to_slotted_class(self):
+        self.assertIs(self.point_klass, self.point_klass.Meta.doc_klass)
+        self.assertIs(self.shelf_klass, self.shelf_klass.Meta.doc_klass)
+        self.assertIs(self.shelf_klass, self.shelf_klass.documents.doc_klass)
+
+    def test_no_instance_dict(self):
+        shelf = self.shelf_klass(name="top", corner=self.point_klass(x=1))
+        self.assertFalse(hasattr(shelf, "__dict__"))
+        self.assertFalse(hasattr(shelf.corner, "__dict__"))
+
+    def test_serialization(self):
+        shelf = self.shelf_klass(id=1, name="top", corner=self.point_klass(x=1), labels=["books"])
+        data = self.shelf_klass.Meta.to_dict(obj=shelf)
+
+        self.assertEqual({"id": 1, "name": "top", "corner": {"x": 1, "y": 0}, "labels": ["books"]}, data)
+        self.assertEqual(shelf, self.shelf_klass.Meta.from_dict(data=data))
+
+    def test_lazy_defaults(self):
+        entity = datastore.Entity(key=self.shelf_klass.documents.build_key(pk=1))
+        entity.update({"name": "top"})
+        lazy = gcp_datastore.LazyDocument(entity=entity, meta=self.shelf_klass.Meta)
+
+        self.assertEqual([], lazy._get_default(name="labels"))
+        self.assertEqual([], lazy.labels)
+        self.assertIsNone(lazy.corner)
+
+
+class TestLookups(unittest.TestCase):
+    def test_startswith(self):
+        expected = [("name", ">=", "ab"), ("name", "<=", "ab\ufffd")]
+        self.assertEqual(expected, Item.documents._build_filter("name__startswith", "ab"))
+
+    def test_comparison_operators(self):
+        self.assertEqual([("size", ">", 1)], Item.documents._build_filter("size__gt", 1))
+        self.assertEqual([("size", ">=", 1)], Item.documents._build_filter("size__gte", 1))
+        self.assertEqual([("size", "<", 1)], Item.documents._build_filter("size__lt", 1))
+        self.assertEqual([("size", "<=", 1)], Item.documents._build_filter("size__lte", 1))
+        self.assertEqual([("size", "=", 1)], Item.documents._build_filter("size__eq", 1))
+        self.assertEqual([("size", "=", 1)], Item.documents._build_filter("size", 1))
+
+    def test_nested_field(self):
+        expected = [("address.street", ">=", "Ma"), ("address.street", "<=", "Ma\ufffd")]
+        self.assertEqual(expected, Profile.documents._build_filter("address.street__startswith", "Ma"))
+
+    def test_invalid_lookups(self):
+        with self.assertRaises(gcp_datastore.exceptions.UnsupportedFormatException):
+            Item.documents._build_filter("size__between", 1)
+        with self.assertRaises(gcp_datastore.exceptions.UnsupportedFormatException):
+            Item.documents._build_filter("size__gt__lt", 1)
+        with self.assertRaises(gcp_datastore.exceptions.ValidationError):
+            Item.documents._build_filter("weight.unit", "kg")
+
+
+class TestPrimaryKeyLookups(DatastoreTestCase):
+    def test_filter_on_auto_generated_id(self):
+        item = Item(name="new")
+        item.save()
+        other = Item(id=5, name="explicit")
+        other.save()
+
+        self.assertNotIn("id", self.client.entities[Item.documents.build_key(pk=item.id)])
+        self.assertEqual([item], list(Item.documents.filter(id=item.id)))
+        self.assertEqual([other], list(Item.documents.filter(id=5)))
+        self.assertEqual([other, item], sorted(Item.documents.filter(id__in=[item.id, 5]), key=lambda doc: doc.id))
+        self.assertEqual([item], list(Item.documents.filter(id__in=[item.id], name__in=["new", "explicit"])))
+
+    def test_pk_filter_uses_key(self):
+        self.assertEqual([("__key__", "=", Item.documents.build_key(pk=5))], Item.documents._build_filter("id", "5"))
+        self.assertEqual(
+            [("__key__", "in", [Item.documents.build_key(pk=5)])], Item.documents._build_filter("id__in", [5])
+        )
+        with self.assertRaises(gcp_datastore.exceptions.UnsupportedFormatException):
+            Item.documents._build_filter("id__startswith", "5")
+
+    def test_order_by_pk_uses_key(self):
+        self.assertEqual("-__key__", Item.documents._build_query(filters=[], order_by="-id").order)
+        self.assertEqual(["name", "__key__"], Item.documents._build_query(filters=[], order_by=["name", "id"]).order)